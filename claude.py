@@ -1,82 +1,240 @@
+import asyncio
+import collections
+import concurrent.futures
+import hashlib
+import io
 import os
 import tempfile
 import zipfile
-import snowflake.connector
-import boto3
-from botocore.exceptions import ClientError
 import streamlit as st
-import io
+import random
+import re
+import threading
+import time
+import uuid
 
-def convert_procedure(sql_code):
-    """
-    Converts an MS SQL Server stored procedure to a Snowflake-compatible stored procedure using AWS Bedrock's Claude model.
-    """
-    client = boto3.client("bedrock-runtime", region_name="us-east-1")
-    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+# Number of procedures sent to Bedrock in a single converse call
+BATCH_SIZE = 4
+
+# Maximum number of Bedrock requests in flight at once
+MAX_CONCURRENT_REQUESTS = 16
+
+# The capture groups exclude the newlines around the code, so matches need no strip()
+_SQL_FENCE = re.compile(r"```sql[ \t]*\n(.*?)\n?```", re.DOTALL)
+_BATCH_RESULT = re.compile(r'<result id="(\d+)">\s*```sql[ \t]*\n(.*?)\n?```\s*</result>', re.DOTALL)
 
-    user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to convert an MS SQL Server stored procedure into a Snowflake-compatible SQL stored procedure using SQL language for procedure conversion. Don't use JavaScript. Write high-quality Snowflake SQL code for the conversion.
+# Output token limit of the Claude model used for conversion
+MAX_OUTPUT_TOKENS = 4096
+
+# Prompt templates, split around the inserted SQL so the constant text is built once at import
+_CONVERT_TMPL = (
+    """Human: You are a highly skilled SQL and Snowflake expert. Your task is to convert an MS SQL Server stored procedure into a Snowflake-compatible SQL stored procedure using SQL language for procedure conversion. Don't use JavaScript. Write high-quality Snowflake SQL code for the conversion.
 
     Ensure the conversion handles all necessary syntax differences between MS SQL Server and Snowflake. Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
     
     Here is the MS SQL Server stored procedure code:
     <task>
-    {sql_code}
+    """,
+    """
     </task>
     
     Assistant:
-    """
-    
-    conversation = [
-        {
-            "role": "user",
-            "content": [{"text": user_message}],
-        }
-    ]
+    """,
+)
 
-    try:
-        response = client.converse(
-            modelId=model_id,
-            messages=conversation,
-            inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-            additionalModelRequestFields={"top_k": 250}
-        )
+_BATCH_CONVERT_TMPL = (
+    """Human: You are a highly skilled SQL and Snowflake expert. Your task is to convert each MS SQL Server stored procedure below into a Snowflake-compatible SQL stored procedure using SQL language for procedure conversion. Don't use JavaScript. Write high-quality Snowflake SQL code for each conversion.
 
-        response_text = response["output"]["message"]["content"][0]["text"]
-        start_index = response_text.find("```sql")
-        end_index = response_text.find("```", start_index + 6)
-        
-        if start_index != -1 and end_index != -1:
-            sql_code_block = response_text[start_index + 6:end_index].strip()
-            return sql_code_block
-        else:
-            return None
+    Ensure the conversion handles all necessary syntax differences between MS SQL Server and Snowflake. Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
 
-    except (ClientError, Exception) as e:
-        print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-        return None
+    Each procedure is wrapped in a <task id="N"> tag. For every task, reply with exactly one <result id="N"> tag with the same id, containing only the converted procedure in a ```sql code block.
 
-def procedure_error_rtry(connection, sql_code, error):
+    Here are the MS SQL Server stored procedures:
+    """,
     """
-    Attempts to resolve an error in creating a Snowflake stored procedure using AWS Bedrock's Claude model.
-    """
-    client = boto3.client("bedrock-runtime", region_name="us-east-1")
-    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
 
-    user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to resolve an issue with a Snowflake stored procedure.
+    Assistant:
+    """,
+)
+
+_ERROR_RETRY_TMPL = (
+    """Human: You are a highly skilled SQL and Snowflake expert. Your task is to resolve an issue with a Snowflake stored procedure.
     You will be provided with a Snowflake stored procedure and its respective error. Try resolving the code issue based on the error message.
 
     Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
     
     Here is the Snowflake stored procedure code:
     <task>
-    {sql_code}
+    """,
+    """
     </task>
     <error>
-    {error}
+    """,
+    """
     </error>
     
     Assistant:
+    """,
+)
+
+# Seconds between status checks for asynchronously submitted Snowflake queries
+SNOWFLAKE_POLL_INTERVAL = 0.5
+
+# Procedures larger than this many bytes are uploaded to a user stage and run from there
+# instead of being sent inline as one large statement
+STAGED_SQL_THRESHOLD = 1024 * 1024
+SQL_UPLOAD_STAGE = "@~/stage_sp_upload"
+
+# Transient failures are retried up to RETRY_ATTEMPTS times with jittered exponential backoff
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.5
+# Compared lowercased: errors raised mid-stream carry lowerCamel codes such as "throttlingException"
+_RETRYABLE_BEDROCK_ERRORS = {"throttlingexception", "serviceunavailableexception", "modelstreamerrorexception"}
+
+# Number of times a rejected procedure is sent back to the model for correction
+MAX_CORRECTION_ATTEMPTS = 2
+
+# Maximum number of converted procedures kept in the conversion cache
+CONVERSION_CACHE_SIZE = 256
+
+# Converted procedures keyed by a hash of the uploaded SQL, shared across sessions,
+# least recently used first
+_conversion_cache = collections.OrderedDict()
+_conversion_cache_lock = threading.Lock()
+
+def bedrock_client(region="us-east-1"):
+    """
+    Returns an aioboto3 Bedrock runtime client, to be opened with "async with" and shared by
+    every coroutine in a run.
+    """
+    import aioboto3
+    return aioboto3.Session().client("bedrock-runtime", region_name=region)
+
+def _is_transient_error(error):
+    """ Returns True for Bedrock throttling/availability errors and Snowflake connectivity errors. """
+    import snowflake.connector
+    from botocore.exceptions import ClientError
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code", "").lower() in _RETRYABLE_BEDROCK_ERRORS
+    return isinstance(error, snowflake.connector.errors.OperationalError)
+
+def _with_retry(fn, *args, attempts=RETRY_ATTEMPTS, base=RETRY_BASE_DELAY, **kwargs):
+    """
+    Calls fn, retrying transient errors with a random backoff of up to base * 2**attempt seconds.
+    """
+    for attempt in range(attempts):
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not _is_transient_error(e):
+                raise
+            time.sleep(random.uniform(0, base * 2 ** attempt))
+
+async def _with_retry_async(fn, *args, attempts=RETRY_ATTEMPTS, base=RETRY_BASE_DELAY, **kwargs):
+    """ Awaits fn with the same retry policy as _with_retry. """
+    for attempt in range(attempts):
+        try:
+            return await fn(*args, **kwargs)
+        except Exception as e:
+            if attempt == attempts - 1 or not _is_transient_error(e):
+                raise
+            await asyncio.sleep(random.uniform(0, base * 2 ** attempt))
+
+# Latency-optimized inference is opt-in with BEDROCK_LATENCY_OPTIMIZED=1
+_latency_optimized = os.environ.get("BEDROCK_LATENCY_OPTIMIZED") == "1"
+
+def _is_latency_unsupported(error):
+    """ Returns True if Bedrock rejected the request because of its performanceConfig. """
+    details = error.response.get("Error", {})
+    message = details.get("Message", "").lower()
+    return details.get("Code") == "ValidationException" and ("performanceconfig" in message or "latency" in message)
+
+async def _invoke(operation, **kwargs):
+    """
+    Awaits a Bedrock converse operation, requesting latency-optimized inference when enabled.
+    Falls back to standard inference, for the rest of the process, if the model or region
+    does not support it; other validation errors are raised as usual.
     """
+    global _latency_optimized
+    if _latency_optimized:
+        from botocore.exceptions import ClientError
+        try:
+            return await operation(performanceConfig={"latency": "optimized"}, **kwargs)
+        except ClientError as e:
+            if not _is_latency_unsupported(e):
+                raise
+            _latency_optimized = False
+    return await operation(**kwargs)
+
+async def converse(client, **kwargs):
+    """ Calls Bedrock's converse API and returns the full response. """
+    return await _with_retry_async(_invoke, client.converse, **kwargs)
+
+async def converse_until_sql_block(client, **kwargs):
+    """
+    Streams a Bedrock converse response and returns the text received so far
+    as soon as a complete ```sql block has arrived, skipping any trailing commentary.
+    If the response hit its token limit before the block closed, it is requested once more
+    with MAX_OUTPUT_TOKENS.
+    """
+    response_text, stop_reason = await _with_retry_async(_read_until_sql_block, client, **kwargs)
+    inference_config = kwargs.get("inferenceConfig", {})
+    if stop_reason == "max_tokens" and inference_config.get("maxTokens", MAX_OUTPUT_TOKENS) < MAX_OUTPUT_TOKENS:
+        kwargs["inferenceConfig"] = {**inference_config, "maxTokens": MAX_OUTPUT_TOKENS}
+        response_text, _ = await _with_retry_async(_read_until_sql_block, client, **kwargs)
+    return response_text
+
+async def _read_until_sql_block(client, **kwargs):
+    stream = (await _invoke(client.converse_stream, **kwargs))["stream"]
+    response_text = ""
+    stop_reason = None
+    start_index = -1
+    try:
+        async for event in stream:
+            delta = event.get("contentBlockDelta")
+            if delta is None:
+                stop_reason = event.get("messageStop", {}).get("stopReason", stop_reason)
+                continue
+            scan_from = max(0, len(response_text) - 6)
+            response_text += delta["delta"].get("text", "")
+
+            if start_index == -1:
+                start_index = response_text.find("```sql", scan_from)
+                if start_index == -1:
+                    continue
+                scan_from = start_index + 6
+            if response_text.find("```", max(scan_from, start_index + 6)) != -1:
+                break
+    finally:
+        stream.close()
+    return response_text, stop_reason
+
+def max_output_tokens(sql_code, floor=512):
+    """
+    Estimates the output token budget for converting the given SQL: roughly one token per
+    three characters plus headroom for Snowflake syntax, capped at MAX_OUTPUT_TOKENS.
+    """
+    return min(MAX_OUTPUT_TOKENS, max(floor, len(sql_code) // 3 + 256))
+
+async def convert_procedure(client, sql_code):
+    """
+    Converts an MS SQL Server stored procedure to a Snowflake-compatible stored procedure using AWS Bedrock's Claude model.
+    """
+    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+    try:
+        response_text = await converse_until_sql_block(client, **_conversion_request(sql_code, model_id))
+
+        match = _SQL_FENCE.search(response_text)
+        return match.group(1) if match else None
+
+    except Exception as e:
+        print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
+        return None
+
+def _conversion_request(sql_code, model_id):
+    """ Builds the converse arguments for converting a single procedure. """
+    user_message = "".join((_CONVERT_TMPL[0], sql_code, _CONVERT_TMPL[1]))
     
     conversation = [
         {
@@ -85,61 +243,363 @@ def procedure_error_rtry(connection, sql_code, error):
         }
     ]
 
+    return dict(
+        modelId=model_id,
+        messages=conversation,
+        inferenceConfig={"maxTokens": max_output_tokens(sql_code), "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
+        additionalModelRequestFields={"top_k": 250}
+    )
+
+async def convert_procedures_batch(client, sql_codes):
+    """
+    Converts several MS SQL Server stored procedures in a single Bedrock call.
+    Returns one converted procedure per input, with None for any result that could not be parsed.
+    """
+    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
     try:
-        response = client.converse(
-            modelId=model_id,
-            messages=conversation,
-            inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-            additionalModelRequestFields={"top_k": 250}
-        )
+        response = await converse(client, **_batch_conversion_request(sql_codes, model_id))
+        return _parse_batch_response(response, len(sql_codes))
 
-        response_text = response["output"]["message"]["content"][0]["text"]
-        start_index = response_text.find("```sql")
-        end_index = response_text.find("```", start_index + 6)
-        
-        if start_index != -1 and end_index != -1:
-            sql_code_block = response_text[start_index + 6:end_index].strip()
-            return sql_code_block
-        else:
-            return None
+    except Exception as e:
+        print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
+        return [None] * len(sql_codes)
+
+def _batch_conversion_request(sql_codes, model_id):
+    """ Builds the converse arguments for converting several procedures in one call. """
+    tasks = "\n".join(f'<task id="{i}">\n{sql_code}\n</task>' for i, sql_code in enumerate(sql_codes, start=1))
+
+    user_message = "".join((_BATCH_CONVERT_TMPL[0], tasks, _BATCH_CONVERT_TMPL[1]))
 
-    except (ClientError, Exception) as e:
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": user_message}],
+        }
+    ]
+
+    return dict(
+        modelId=model_id,
+        messages=conversation,
+        inferenceConfig={"maxTokens": sum(max_output_tokens(sql_code) for sql_code in sql_codes), "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
+        additionalModelRequestFields={"top_k": 250}
+    )
+
+def _parse_batch_response(response, count):
+    """ Extracts the converted procedure for each task id from a batch response. """
+    results = [None] * count
+    response_text = response["output"]["message"]["content"][0]["text"]
+    for match in _BATCH_RESULT.finditer(response_text):
+        index = int(match.group(1)) - 1
+        if 0 <= index < count:
+            results[index] = match.group(2) or None
+    return results
+
+def procedure_error_rtry(connection, sql_code, error):
+    """
+    Attempts to resolve an error in creating a Snowflake stored procedure using AWS Bedrock's Claude model.
+    """
+    return asyncio.run(_procedure_error_rtry(sql_code, error))
+
+async def _procedure_error_rtry(sql_code, error):
+    model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+
+    user_message = "".join((_ERROR_RETRY_TMPL[0], sql_code, _ERROR_RETRY_TMPL[1], error, _ERROR_RETRY_TMPL[2]))
+    
+    conversation = [
+        {
+            "role": "user",
+            "content": [{"text": user_message}],
+        }
+    ]
+
+    try:
+        async with bedrock_client() as client:
+            response_text = await converse_until_sql_block(
+                client,
+                modelId=model_id,
+                messages=conversation,
+                inferenceConfig={"maxTokens": max_output_tokens(sql_code, floor=1024), "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
+                additionalModelRequestFields={"top_k": 250}
+            )
+
+        match = _SQL_FENCE.search(response_text)
+        return match.group(1) if match else None
+
+    except Exception as e:
         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
         return None
 
-def create_stored_procedure_in_snowflake(connection, sql_code):
+def is_staged_sql(sql_code):
+    """ Returns True if the SQL code is large enough to be executed from a stage. """
+    # A character encodes to 1-4 UTF-8 bytes, so only encode when the length alone can't decide
+    if len(sql_code) > STAGED_SQL_THRESHOLD:
+        return True
+    if len(sql_code) * 4 <= STAGED_SQL_THRESHOLD:
+        return False
+    return len(sql_code.encode("utf-8")) > STAGED_SQL_THRESHOLD
+
+def execute_procedure_sql(cursor, sql_code):
+    """
+    Executes SQL code on the cursor. Large code is streamed to a user stage with PUT and
+    run with EXECUTE IMMEDIATE FROM, rather than sent as one oversized statement.
+    Each statement is retried on its own if it fails with a transient error.
+    """
+    if not is_staged_sql(sql_code):
+        return _with_retry(cursor.execute, sql_code)
+
+    file_name = f"{uuid.uuid4().hex}.sql"
+    sql_bytes = sql_code.encode("utf-8")
+    # A fresh stream per attempt, since a failed PUT may have consumed the previous one
+    _with_retry(
+        lambda: cursor.execute(
+            f"PUT 'file://{file_name}' {SQL_UPLOAD_STAGE} AUTO_COMPRESS=FALSE OVERWRITE=TRUE",
+            file_stream=io.BytesIO(sql_bytes),
+        )
+    )
+    try:
+        return _with_retry(cursor.execute, f"EXECUTE IMMEDIATE FROM '{SQL_UPLOAD_STAGE}/{file_name}'")
+    finally:
+        # Don't let a failed cleanup replace the EXECUTE result or its error
+        try:
+            _with_retry(cursor.execute, f"REMOVE '{SQL_UPLOAD_STAGE}/{file_name}'")
+        except Exception as e:
+            print(f"ERROR: Can't remove staged file '{file_name}'. Reason: {e}")
+
+def create_stored_procedure_in_snowflake(connection, cursor, sql_code):
     """
-    Executes the given SQL code to create a stored procedure in Snowflake.
+    Executes the given SQL code on the caller's cursor to create a stored procedure in Snowflake.
     """
+    import snowflake.connector
     try:
-        cursor = connection.cursor()
-        cursor.execute(sql_code)
+        execute_procedure_sql(cursor, sql_code)
         return True
     except snowflake.connector.errors.ProgrammingError as e:
-        corrected_sql_code = procedure_error_rtry(connection, sql_code, str(e))
-        if corrected_sql_code:
-            try:
-                cursor.execute(corrected_sql_code)
-                return True
-            except snowflake.connector.errors.ProgrammingError:
-                return False
-    finally:
-        cursor.close()
+        return retry_stored_procedure_in_snowflake(connection, cursor, sql_code, str(e))
+
+def retry_stored_procedure_in_snowflake(connection, cursor, sql_code, error):
+    """
+    Asks the model to correct a procedure that Snowflake rejected and executes the corrected code.
+    If the corrected code is rejected too, its new error is sent back for another correction,
+    up to MAX_CORRECTION_ATTEMPTS times.
+    """
+    import snowflake.connector
+    for _ in range(MAX_CORRECTION_ATTEMPTS):
+        corrected_sql_code = procedure_error_rtry(connection, sql_code, error)
+        if not corrected_sql_code:
+            return False
+        try:
+            execute_procedure_sql(cursor, corrected_sql_code)
+            return True
+        except snowflake.connector.errors.ProgrammingError as e:
+            sql_code, error = corrected_sql_code, str(e)
     return False
 
-def process_sql_code(sql_code):
-    """ Converts SQL code and returns the result. """
-    converted_code = convert_procedure(sql_code)
-    return converted_code
+def wait_for_snowflake_query(connection, query_id):
+    """
+    Polls an asynchronously submitted Snowflake query until it finishes.
+    Returns the error message if the query failed, otherwise None.
+    """
+    import snowflake.connector
+    while connection.is_still_running(connection.get_query_status(query_id)):
+        time.sleep(SNOWFLAKE_POLL_INTERVAL)
+    try:
+        connection.get_query_status_throw_if_error(query_id)
+    except snowflake.connector.errors.ProgrammingError as e:
+        return str(e)
+    return None
+
+def submit_stored_procedures_in_snowflake(cursor, sql_codes):
+    """
+    Starts creating the given procedures without waiting for them to finish. Procedures small
+    enough to send inline go out as one asynchronous query, as a multi-statement request when
+    there are several. Returns a (query_id, error) submission for finish_stored_procedures_in_snowflake.
+    """
+    import snowflake.connector
+    inline_sql_codes = [sql_code for sql_code in sql_codes if not is_staged_sql(sql_code)]
+    if not inline_sql_codes:
+        return None, None
+
+    try:
+        if len(inline_sql_codes) == 1:
+            _with_retry(cursor.execute_async, inline_sql_codes[0])
+        else:
+            batched_sql = ";\n".join(sql_code.rstrip().rstrip(";") for sql_code in inline_sql_codes)
+            _with_retry(cursor.execute_async, batched_sql, num_statements=len(inline_sql_codes))
+        return cursor.sfqid, None
+    except snowflake.connector.errors.ProgrammingError as e:
+        return None, str(e)
+
+def finish_stored_procedures_in_snowflake(connection, cursor, sql_codes, submission):
+    """
+    Waits for procedures started by submit_stored_procedures_in_snowflake. If the submitted query
+    failed, each procedure is created on its own so procedure_error_rtry can fix the offending one.
+    Procedures too large to send inline are created here from a stage.
+    Returns a list of booleans indicating which procedures were created.
+    """
+    query_id, error = submission
+    if query_id is not None:
+        error = wait_for_snowflake_query(connection, query_id)
+    staged = [is_staged_sql(sql_code) for sql_code in sql_codes]
+    inline_count = staged.count(False)
+
+    created = []
+    for sql_code, is_staged in zip(sql_codes, staged):
+        if is_staged:
+            created.append(create_stored_procedure_in_snowflake(connection, cursor, sql_code))
+        elif error is None:
+            created.append(True)
+        elif inline_count == 1:
+            created.append(retry_stored_procedure_in_snowflake(connection, cursor, sql_code, error))
+        else:
+            created.append(create_stored_procedure_in_snowflake(connection, cursor, sql_code))
+    return created
+
+async def process_sql_batch(client, sql_buffers):
+    """ Decodes and converts a batch of uploaded SQL files in one call, retrying unparsed items individually. """
+    sql_codes = [str(sql_buffer, "utf-8", errors="replace") for sql_buffer in sql_buffers]
+    if len(sql_codes) == 1:
+        return [await convert_procedure(client, sql_codes[0])]
+
+    converted_codes = await convert_procedures_batch(client, sql_codes)
+    missing = [index for index, converted_code in enumerate(converted_codes) if not converted_code]
+    retried = await asyncio.gather(*(convert_procedure(client, sql_codes[index]) for index in missing))
+    for index, converted_code in zip(missing, retried):
+        converted_codes[index] = converted_code
+    return converted_codes
+
+async def convert_batches(batches, on_batch_done=None):
+    """
+    Converts all batches concurrently on a single event loop with one shared Bedrock client,
+    keeping at most MAX_CONCURRENT_REQUESTS batches in flight. on_batch_done(index, codes) is
+    called for each batch as soon as it finishes.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def convert(client, index, batch):
+        async with semaphore:
+            try:
+                return index, await process_sql_batch(client, batch)
+            except Exception as e:
+                print(f"ERROR: Can't convert batch {index}. Reason: {e}")
+                return index, [None] * len(batch)
+
+    results = [None] * len(batches)
+    async with bedrock_client() as client:
+        for next_done in asyncio.as_completed([convert(client, index, batch) for index, batch in enumerate(batches)]):
+            index, converted_codes = await next_done
+            results[index] = converted_codes
+            if on_batch_done:
+                on_batch_done(index, converted_codes)
+    return results
+
+def _group_by_output_budget(keys, sql_buffer_for):
+    """
+    Groups keys into batches of at most BATCH_SIZE whose summed max_output_tokens stays within
+    MAX_OUTPUT_TOKENS, so a batch response is never truncated by the shared output cap.
+    """
+    key_batches = []
+    key_batch, budget = [], 0
+    for key in keys:
+        tokens = max_output_tokens(sql_buffer_for(key))
+        if key_batch and (len(key_batch) >= BATCH_SIZE or budget + tokens > MAX_OUTPUT_TOKENS):
+            key_batches.append(key_batch)
+            key_batch, budget = [], 0
+        key_batch.append(key)
+        budget += tokens
+    if key_batch:
+        key_batches.append(key_batch)
+    return key_batches
+
+def convert_sql_buffers(sql_buffers, on_converted=None):
+    """
+    Converts uploaded SQL files, sending each distinct input to Bedrock only once.
+    If given, on_converted(index_groups, codes) is called on the calling thread as results arrive:
+    first for inputs already in the cache, then once per finished batch. Each distinct input
+    appears once, with index_groups listing the indices of every buffer that shares its code.
+    Returns the converted code for every buffer, in order, with None where conversion failed.
+    """
+    keys = [hashlib.blake2b(sql_buffer, digest_size=16).digest() for sql_buffer in sql_buffers]
+    indices_by_key = {}
+    for index, key in enumerate(keys):
+        indices_by_key.setdefault(key, []).append(index)
+
+    with _conversion_cache_lock:
+        results = {key: _conversion_cache[key] for key in indices_by_key if key in _conversion_cache}
+        for key in results:
+            _conversion_cache.move_to_end(key)
+
+    def report(batch_keys, converted_codes):
+        converted = dict(zip(batch_keys, converted_codes))
+        results.update(converted)
+        with _conversion_cache_lock:
+            _conversion_cache.update((key, code) for key, code in converted.items() if code)
+            while len(_conversion_cache) > CONVERSION_CACHE_SIZE:
+                _conversion_cache.popitem(last=False)
+        if on_converted:
+            on_converted([indices_by_key[key] for key in batch_keys], [converted[key] for key in batch_keys])
+
+    if results:
+        report(list(results), list(results.values()))
+
+    pending_keys = [key for key in indices_by_key if key not in results]
+    if pending_keys:
+        # Bedrock calls are network-bound, so convert batches of files concurrently on one event loop
+        key_batches = _group_by_output_budget(pending_keys, lambda key: sql_buffers[indices_by_key[key][0]])
+        batches = [[sql_buffers[indices_by_key[key][0]] for key in key_batch] for key_batch in key_batches]
+        asyncio.run(convert_batches(batches, lambda index, codes: report(key_batches[index], codes)))
+
+    return [results[key] for key in keys]
 
 def create_zip_file(converted_files):
-    """Creates a zip file containing all converted SQL files."""
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
+    """
+    Creates a compressed zip file on disk containing all converted SQL files and returns its path.
+    The caller is responsible for deleting the file once it has been read.
+    """
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".zip") as temp_file:
+        zip_path = temp_file.name
+
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=6) as zip_file:
         for file_name, converted_code in converted_files:
             zip_file.writestr(file_name, converted_code)
-    zip_buffer.seek(0)  # Move to the beginning of the BytesIO buffer
-    return zip_buffer
+    return zip_path
+
+def get_snowflake_credentials():
+    """
+    Returns the Snowflake connection settings from the [snowflake] section of st.secrets,
+    falling back to SNOWFLAKE_* environment variables.
+    """
+    try:
+        return dict(st.secrets["snowflake"])
+    except (KeyError, FileNotFoundError):
+        pass
+
+    credentials = {
+        "user": os.environ.get("SNOWFLAKE_USER"),
+        "password": os.environ.get("SNOWFLAKE_PASSWORD"),
+        "account": os.environ.get("SNOWFLAKE_ACCOUNT"),
+        "warehouse": os.environ.get("SNOWFLAKE_WAREHOUSE", "COMPUTE_WH"),
+        "database": os.environ.get("SNOWFLAKE_DATABASE", "GAM_PDW"),
+        "schema": os.environ.get("SNOWFLAKE_SCHEMA", "DBO"),
+        "role": os.environ.get("SNOWFLAKE_ROLE", "DATA_MIGRATION_ROLE"),
+    }
+    missing = [key for key, value in credentials.items() if not value]
+    if missing:
+        raise ValueError(f"Missing Snowflake settings: {', '.join(missing)}")
+    return credentials
+
+@st.cache_resource(validate=lambda connection: not connection.is_closed())
+def get_snowflake_connection():
+    """
+    Opens a Snowflake connection that is shared by every rerun and session of the app,
+    so the login handshake only happens once per process (or after the connection closes).
+    """
+    import snowflake.connector
+    return snowflake.connector.connect(
+        **get_snowflake_credentials(),
+        client_session_keep_alive=True,
+        paramstyle="qmark",
+    )
 
 def main():
     st.title("MS SQL Server to Snowflake Procedure Converter")
@@ -153,31 +613,57 @@ def main():
             created_successfully = []
             not_created_files = []
 
-            # Snowflake connection
+            # Snowflake connection, reused across reruns
             try:
-                snowflake_connection = snowflake.connector.connect(
-                    user='azadk',
-                    password='Azad@@1786',
-                    account='oq43111.ap-south-1.aws',
-                    warehouse='COMPUTE_WH',
-                    database='GAM_PDW',
-                    schema='DBO',
-                    role='DATA_MIGRATION_ROLE'
-                )
-
-                for uploaded_file in uploaded_files:
-                    sql_code = uploaded_file.read().decode("utf-8")
-                    converted_code = process_sql_code(sql_code)
-
-                    if converted_code:
-                        converted_files.append((os.path.basename(uploaded_file.name), converted_code))
-
-                        if create_stored_procedure_in_snowflake(snowflake_connection, converted_code):
-                            created_successfully.append(os.path.basename(uploaded_file.name))
-                        else:
-                            not_created_files.append(os.path.basename(uploaded_file.name))
-                    else:
-                        not_created_files.append(os.path.basename(uploaded_file.name))
+                snowflake_connection = get_snowflake_connection()
+
+                # Take zero-copy views of the uploads on the main thread; UploadedFile is not
+                # thread-safe, so decoding happens in the workers from these buffers
+                file_names = [os.path.basename(uploaded_file.name) for uploaded_file in uploaded_files]
+                sql_buffers = [uploaded_file.getbuffer() for uploaded_file in uploaded_files]
+
+                total = len(file_names)
+                submissions = []
+                with st.status(f"Converting {total} files...", expanded=True) as status:
+                    cursor = snowflake_connection.cursor()
+                    try:
+                        # Submissions block on Snowflake, so they run on one worker thread (keeping
+                        # the cursor single-threaded) instead of stalling the conversion event loop
+                        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as submit_executor:
+                            def on_converted(index_groups, converted_codes):
+                                # Show each file as it lands and start its CREATE PROCEDURE right away,
+                                # once per distinct procedure even if several uploads share it
+                                landed = []
+                                for indices, converted_code in zip(index_groups, converted_codes):
+                                    group_names = [file_names[index] for index in indices]
+                                    if converted_code:
+                                        for index, file_name in zip(indices, group_names):
+                                            converted_files.append((file_name, converted_code))
+                                            st.download_button(label=f"Download {file_name}", data=converted_code, file_name=file_name, mime='text/plain', key=f"download-{index}")
+                                        landed.append((group_names, converted_code))
+                                    else:
+                                        for file_name in group_names:
+                                            not_created_files.append(file_name)
+                                            st.write(f"Could not convert {file_name}")
+                                if landed:
+                                    sql_codes = [converted_code for _, converted_code in landed]
+                                    submissions.append((landed, submit_executor.submit(submit_stored_procedures_in_snowflake, cursor, sql_codes)))
+                                status.update(label=f"Converted {len(converted_files) + len(not_created_files)}/{total} files")
+
+                            convert_sql_buffers(sql_buffers, on_converted)
+
+                        status.update(label="Waiting for Snowflake to create the procedures...")
+                        for landed, submission in submissions:
+                            sql_codes = [converted_code for _, converted_code in landed]
+                            created = finish_stored_procedures_in_snowflake(snowflake_connection, cursor, sql_codes, submission.result())
+                            for (group_names, _), was_created in zip(landed, created):
+                                if was_created:
+                                    created_successfully.extend(group_names)
+                                else:
+                                    not_created_files.extend(group_names)
+                    finally:
+                        cursor.close()
+                    status.update(label=f"Converted {len(converted_files)}/{total} files", state="complete", expanded=False)
 
                 # Display results
                 st.success("Conversion Complete!")
@@ -191,461 +677,18 @@ def main():
                 st.write(not_created_files)
 
                 # Create a zip file for download
-                zip_file = create_zip_file(converted_files)
-                st.download_button(label="Download All Converted Files", data=zip_file, file_name="converted_procedures.zip", mime='application/zip')
+                zip_path = create_zip_file(converted_files)
+                try:
+                    # download_button reads the file into memory, so it can be removed right away
+                    with open(zip_path, 'rb') as zip_file:
+                        st.download_button(label="Download All Converted Files", data=zip_file, file_name="converted_procedures.zip", mime='application/zip')
+                finally:
+                    os.unlink(zip_path)
 
             except Exception as e:
                 st.error(f"Failed to connect to Snowflake: {e}")
-            finally:
-                snowflake_connection.close()
         else:
             st.warning("Please upload at least one SQL file.")
 
 if __name__ == "__main__":
     main()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-# import os
-# import tempfile
-# import snowflake.connector
-# import boto3
-# from botocore.exceptions import ClientError
-# import streamlit as st
-
-# def convert_procedure(sql_code):
-#     """
-#     Converts an MS SQL Server stored procedure to a Snowflake-compatible stored procedure using AWS Bedrock's Claude model.
-#     """
-#     client = boto3.client("bedrock-runtime", region_name="us-east-1")
-#     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
-#     user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to convert an MS SQL Server stored procedure into a Snowflake-compatible SQL stored procedure using SQL language for procedure conversion. Don't use JavaScript. Write high-quality Snowflake SQL code for the conversion.
-
-#     Ensure the conversion handles all necessary syntax differences between MS SQL Server and Snowflake. Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
-    
-#     Here is the MS SQL Server stored procedure code:
-#     <task>
-#     {sql_code}
-#     </task>
-    
-#     Assistant:
-#     """
-    
-#     conversation = [
-#         {
-#             "role": "user",
-#             "content": [{"text": user_message}],
-#         }
-#     ]
-
-#     try:
-#         response = client.converse(
-#             modelId=model_id,
-#             messages=conversation,
-#             inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-#             additionalModelRequestFields={"top_k": 250}
-#         )
-
-#         response_text = response["output"]["message"]["content"][0]["text"]
-#         start_index = response_text.find("```sql")
-#         end_index = response_text.find("```", start_index + 6)
-        
-#         if start_index != -1 and end_index != -1:
-#             sql_code_block = response_text[start_index + 6:end_index].strip()
-#             return sql_code_block
-#         else:
-#             return None
-
-#     except (ClientError, Exception) as e:
-#         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-#         return None
-
-# def procedure_error_rtry(connection, sql_code, error):
-#     """
-#     Attempts to resolve an error in creating a Snowflake stored procedure using AWS Bedrock's Claude model.
-#     """
-#     client = boto3.client("bedrock-runtime", region_name="us-east-1")
-#     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
-#     user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to resolve an issue with a Snowflake stored procedure.
-#     You will be provided with a Snowflake stored procedure and its respective error. Try resolving the code issue based on the error message.
-
-#     Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
-    
-#     Here is the Snowflake stored procedure code:
-#     <task>
-#     {sql_code}
-#     </task>
-#     <error>
-#     {error}
-#     </error>
-    
-#     Assistant:
-#     """
-    
-#     conversation = [
-#         {
-#             "role": "user",
-#             "content": [{"text": user_message}],
-#         }
-#     ]
-
-#     try:
-#         response = client.converse(
-#             modelId=model_id,
-#             messages=conversation,
-#             inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-#             additionalModelRequestFields={"top_k": 250}
-#         )
-
-#         response_text = response["output"]["message"]["content"][0]["text"]
-#         start_index = response_text.find("```sql")
-#         end_index = response_text.find("```", start_index + 6)
-        
-#         if start_index != -1 and end_index != -1:
-#             sql_code_block = response_text[start_index + 6:end_index].strip()
-#             return sql_code_block
-#         else:
-#             return None
-
-#     except (ClientError, Exception) as e:
-#         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-#         return None
-
-# def create_stored_procedure_in_snowflake(connection, sql_code):
-#     """
-#     Executes the given SQL code to create a stored procedure in Snowflake.
-#     """
-#     try:
-#         cursor = connection.cursor()
-#         cursor.execute(sql_code)
-#         return True
-#     except snowflake.connector.errors.ProgrammingError as e:
-#         corrected_sql_code = procedure_error_rtry(connection, sql_code, str(e))
-#         if corrected_sql_code:
-#             try:
-#                 cursor.execute(corrected_sql_code)
-#                 return True
-#             except snowflake.connector.errors.ProgrammingError:
-#                 return False
-#     finally:
-#         cursor.close()
-#     return False
-
-# def process_sql_code(sql_code):
-#     """ Converts SQL code and returns the result. """
-#     converted_code = convert_procedure(sql_code)
-#     return converted_code
-
-# def main():
-#     st.title("MS SQL Server to Snowflake Procedure Converter")
-    
-#     # File uploader
-#     uploaded_files = st.file_uploader("Upload SQL files", type=["sql"], accept_multiple_files=True)
-
-#     if st.button("Convert"):
-#         if uploaded_files:
-#             converted_files = []
-#             created_successfully = []
-#             not_created_files = []
-
-#             # Snowflake connection
-#             try:
-#                 snowflake_connection = snowflake.connector.connect(
-#                     user='azadk',
-#                     password='Azad@@1786',
-#                     account='oq43111.ap-south-1.aws',
-#                     warehouse='COMPUTE_WH',
-#                     database='GAM_PDW',
-#                     schema='DBO',
-#                     role='DATA_MIGRATION_ROLE'
-#                 )
-
-#                 for uploaded_file in uploaded_files:
-#                     sql_code = uploaded_file.read().decode("utf-8")
-#                     converted_code = process_sql_code(sql_code)
-
-#                     if converted_code:
-#                         # Save the converted code and its filename for download
-#                         converted_files.append((os.path.basename(uploaded_file.name), converted_code))
-
-#                         if create_stored_procedure_in_snowflake(snowflake_connection, converted_code):
-#                             created_successfully.append(os.path.basename(uploaded_file.name))
-#                         else:
-#                             not_created_files.append(os.path.basename(uploaded_file.name))
-#                     else:
-#                         not_created_files.append(os.path.basename(uploaded_file.name))
-
-#                 # Display results
-#                 st.success("Conversion Complete!")
-                
-#                 # Files successfully created in Snowflake
-#                 st.subheader("Successfully Created Procedures in Snowflake:")
-#                 st.write(created_successfully)
-
-#                 # Files that were not created
-#                 st.subheader("Not Created Procedures:")
-#                 st.write(not_created_files)
-
-#                 st.subheader("Converted Files:")
-#                 for file_name, converted_code in converted_files:
-#                     st.download_button(label=f"Download {file_name}", data=converted_code, file_name=file_name, mime='text/plain')
-
-#             except Exception as e:
-#                 st.error(f"Failed to connect to Snowflake: {e}")
-#             finally:
-#                 snowflake_connection.close()
-#         else:
-#             st.warning("Please upload at least one SQL file.")
-
-# if __name__ == "__main__":
-#     main()
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-# import os
-# import tempfile
-# import snowflake.connector
-# import boto3
-# from botocore.exceptions import ClientError
-# import streamlit as st
-
-# def convert_procedure(sql_code):
-#     """
-#     Converts an MS SQL Server stored procedure to a Snowflake-compatible stored procedure using AWS Bedrock's Claude model.
-#     """
-#     client = boto3.client("bedrock-runtime", region_name="us-east-1")
-#     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
-#     user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to convert an MS SQL Server stored procedure into a Snowflake-compatible SQL stored procedure using SQL language for procedure conversion. Don't use JavaScript. Write high-quality Snowflake SQL code for the conversion.
-
-#     Ensure the conversion handles all necessary syntax differences between MS SQL Server and Snowflake. Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
-    
-#     Here is the MS SQL Server stored procedure code:
-#     <task>
-#     {sql_code}
-#     </task>
-    
-#     Assistant:
-#     """
-    
-#     conversation = [
-#         {
-#             "role": "user",
-#             "content": [{"text": user_message}],
-#         }
-#     ]
-
-#     try:
-#         response = client.converse(
-#             modelId=model_id,
-#             messages=conversation,
-#             inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-#             additionalModelRequestFields={"top_k": 250}
-#         )
-
-#         response_text = response["output"]["message"]["content"][0]["text"]
-#         start_index = response_text.find("```sql")
-#         end_index = response_text.find("```", start_index + 6)
-        
-#         if start_index != -1 and end_index != -1:
-#             sql_code_block = response_text[start_index + 6:end_index].strip()
-#             return sql_code_block
-#         else:
-#             return None
-
-#     except (ClientError, Exception) as e:
-#         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-#         return None
-
-# def procedure_error_rtry(connection, sql_code, error):
-#     """
-#     Attempts to resolve an error in creating a Snowflake stored procedure using AWS Bedrock's Claude model.
-#     """
-#     client = boto3.client("bedrock-runtime", region_name="us-east-1")
-#     model_id = "anthropic.claude-3-5-sonnet-20240620-v1:0"
-
-#     user_message = f"""Human: You are a highly skilled SQL and Snowflake expert. Your task is to resolve an issue with a Snowflake stored procedure.
-#     You will be provided with a Snowflake stored procedure and its respective error. Try resolving the code issue based on the error message.
-
-#     Review your output thoroughly to confirm there are no syntax errors or functional discrepancies.
-    
-#     Here is the Snowflake stored procedure code:
-#     <task>
-#     {sql_code}
-#     </task>
-#     <error>
-#     {error}
-#     </error>
-    
-#     Assistant:
-#     """
-    
-#     conversation = [
-#         {
-#             "role": "user",
-#             "content": [{"text": user_message}],
-#         }
-#     ]
-
-#     try:
-#         response = client.converse(
-#             modelId=model_id,
-#             messages=conversation,
-#             inferenceConfig={"maxTokens": 2048, "stopSequences": ["\n\nHuman:"], "temperature": 0, "topP": 1},
-#             additionalModelRequestFields={"top_k": 250}
-#         )
-
-#         response_text = response["output"]["message"]["content"][0]["text"]
-#         start_index = response_text.find("```sql")
-#         end_index = response_text.find("```", start_index + 6)
-        
-#         if start_index != -1 and end_index != -1:
-#             sql_code_block = response_text[start_index + 6:end_index].strip()
-#             return sql_code_block
-#         else:
-#             return None
-
-#     except (ClientError, Exception) as e:
-#         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-#         return None
-
-# def create_stored_procedure_in_snowflake(connection, sql_code):
-#     """
-#     Executes the given SQL code to create a stored procedure in Snowflake.
-#     """
-#     try:
-#         cursor = connection.cursor()
-#         cursor.execute(sql_code)
-#         return True
-#     except snowflake.connector.errors.ProgrammingError as e:
-#         corrected_sql_code = procedure_error_rtry(connection, sql_code, str(e))
-#         if corrected_sql_code:
-#             try:
-#                 cursor.execute(corrected_sql_code)
-#                 return True
-#             except snowflake.connector.errors.ProgrammingError:
-#                 return False
-#     finally:
-#         cursor.close()
-#     return False
-
-# def process_sql_code(sql_code):
-#     """ Converts SQL code and returns the result. """
-#     converted_code = convert_procedure(sql_code)
-#     return converted_code
-
-# def main():
-#     st.title("MS SQL Server to Snowflake Procedure Converter")
-    
-#     # File uploader
-#     uploaded_files = st.file_uploader("Upload SQL files", type=["sql"], accept_multiple_files=True)
-
-#     if st.button("Convert"):
-#         if uploaded_files:
-#             converted_files = []
-#             not_converted_files = []
-
-#             # Snowflake connection
-#             try:
-#                 snowflake_connection = snowflake.connector.connect(
-#                     user='azadk',
-#                     password='Azad@@1786',
-#                     account='oq43111.ap-south-1.aws',
-#                     warehouse='COMPUTE_WH',
-#                     database='GAM_PDW',
-#                     schema='DBO',
-#                     role='DATA_MIGRATION_ROLE'
-#                 )
-
-#                 for uploaded_file in uploaded_files:
-#                     sql_code = uploaded_file.read().decode("utf-8")
-#                     converted_code = process_sql_code(sql_code)
-
-#                     if converted_code:
-#                         # Save the converted code and its filename for download
-#                         converted_files.append((os.path.basename(uploaded_file.name), converted_code))
-
-#                         if create_stored_procedure_in_snowflake(snowflake_connection, converted_code):
-#                             # Mark as converted successfully
-#                             pass
-#                         else:
-#                             not_converted_files.append(uploaded_file.name)
-#                     else:
-#                         not_converted_files.append(uploaded_file.name)
-
-#                 # Display results
-#                 st.success("Conversion Complete!")
-#                 st.subheader("Converted Files:")
-#                 for file_name, converted_code in converted_files:
-#                     st.download_button(label=f"Download {file_name}", data=converted_code, file_name=file_name, mime='text/plain')
-                    
-#                 st.subheader("Not Converted Files:")
-#                 st.write(not_converted_files)
-
-#             except Exception as e:
-#                 st.error(f"Failed to connect to Snowflake: {e}")
-#             finally:
-#                 snowflake_connection.close()
-#         else:
-#             st.warning("Please upload at least one SQL file.")
-
-# if __name__ == "__main__":
-#     main()